@@ -1,16 +1,204 @@
-import os
-import json
-import tempfile
+# gevent doit patcher les sockets avant l'import de requests / flask
+from gevent import monkey
+
+monkey.patch_all()
 
-from flask import Flask, request, Response, jsonify
+import os
+import re
+import sys
+import atexit
+import gzip
+import hashlib
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from urllib.parse import quote_from_bytes
+
+from flask import (
+    Flask,
+    request,
+    Response,
+    jsonify,
+    stream_with_context,
+)
+from flask.json.provider import JSONProvider
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    Field,
+    File,
+    MultipartDecoder,
+    NeedData,
+)
+import brotli
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
 import fal_client
+from cachetools import TLRUCache, TTLCache
 
 FAL_KEY_ENV = "FAL_KEY"
 FAL_BASE_ENV = "FAL_BASE_URL"
 
 DEFAULT_FAL_BASE = "https://fal.run"
 TIMEOUT_SECONDS = 300
+CONNECT_TIMEOUT_SECONDS = 10  # Fal injoignable : échec rapide, sans attendre TIMEOUT_SECONDS
+STREAM_CHUNK_SIZE = 64 * 1024
+FORM_READ_SIZE = 1 << 20  # lecture du multipart /ui/edit par blocs de 1 Mio
+RESPONSE_CACHE_MAX_BYTES = 64 << 20  # corps en cache cumulés, par worker
+RESPONSE_CACHE_MAX_ENTRY = 1 << 20  # au-delà, ou sans Content-Length : relayé en flux
+RESPONSE_CACHE_ENTRY_OVERHEAD = 1024  # clé et en-têtes d'une entrée, estimés
+STATUS_CACHE_TTL = 2  # secondes, endpoints /status sans Cache-Control
+UPLOAD_CACHE_MAXSIZE = 512
+UPLOAD_CACHE_TTL = 3600
+MAX_UPLOAD_WORKERS = 64  # uploads simultanés par processus, tous formulaires confondus
+INDEX_MAX_AGE = 3600
+MAX_CONTENT_LENGTH = 50 << 20  # corps de requête refusé (413) au-delà
+MAX_EDIT_IMAGES = 8
+MAX_IMAGE_SIZE = 20 << 20
+EXTRA_CACHE_MAXSIZE = 256
+EXTRA_CACHE_MAX_LEN = 4096  # extra_json plus longs : parsés sans passer par le cache
+# Appels simultanés par worker gevent (cf. gunicorn.conf.py) : le pool
+# garde une connexion réutilisable pour chacun au lieu de les jeter.
+WORKER_CONNECTIONS = int(os.environ.get("WORKER_CONNECTIONS", "1000"))
+# Appels Fal simultanés admis par processus ; au-delà, attente bornée puis 503
+FAL_MAX_CONCURRENCY = int(os.environ.get("FAL_MAX_CONCURRENCY", "32"))
+FAL_ACQUIRE_TIMEOUT = 5  # secondes
+FAL_RETRY_AFTER = 5  # secondes, indiqué au client dans Retry-After
+
+# Keepalive TCP sur les sockets du pool (Linux : sondes après 60 s d'inactivité)
+_KEEPALIVE_SOCKET_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    _KEEPALIVE_SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 15),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4),
+    ]
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter dont les connexions activent le keepalive TCP : une connexion
+    inactive du pool n'est pas coupée en silence par un NAT / load balancer,
+    ce qui évite un nouveau handshake TLS au prochain appel vers Fal.
+    Les corps de requête en flux partent par blocs de STREAM_CHUNK_SIZE.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = (
+            HTTPConnection.default_socket_options + _KEEPALIVE_SOCKET_OPTIONS
+        )
+        # Corps relayés en flux : envoyés par blocs de STREAM_CHUNK_SIZE
+        # (16 Kio par défaut dans urllib3)
+        kwargs["blocksize"] = STREAM_CHUNK_SIZE
+        super().init_poolmanager(*args, **kwargs)
+
+
+# Session HTTP partagée : les connexions TLS vers Fal sont réutilisées
+# d'une requête à l'autre au lieu d'un handshake complet par appel.
+# http:// partage le même adaptateur (FAL_BASE_URL vers une passerelle locale).
+_ADAPTER = KeepAliveAdapter(
+    pool_connections=64,
+    pool_maxsize=WORKER_CONNECTIONS,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE", "PATCH"]),
+        raise_on_status=False,
+    ),
+)
+_SESSION = requests.Session()
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
+# Corps relayés en flux (RequestBodyStream, chunked) : impossibles à rejouer
+# une fois envoyés. Seuls les échecs de connexion, avant le premier octet,
+# sont retentés ; un 502/503/504 de Fal est relayé tel quel au client.
+_STREAM_ADAPTER = KeepAliveAdapter(
+    pool_connections=64,
+    pool_maxsize=WORKER_CONNECTIONS,
+    max_retries=Retry(
+        total=2,
+        connect=2,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=0.2,
+        raise_on_status=False,
+    ),
+)
+_STREAM_SESSION = requests.Session()
+_STREAM_SESSION.mount("https://", _STREAM_ADAPTER)
+_STREAM_SESSION.mount("http://", _STREAM_ADAPTER)
+
+# En-têtes jamais relayés tels quels (requête entrante / réponse Fal) :
+# hop-by-hop RFC 7230 + ceux que le proxy recalcule lui-même
+_HOP_BY_HOP_REQ = frozenset({
+    "host",
+    "authorization",
+    "content-length",
+    "connection",
+    "proxy-connection",
+    "proxy-authorization",
+    "keep-alive",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+})
+# Content-Encoding / Content-Length passent : le corps est relayé compressé, tel quel
+_HOP_BY_HOP_RESP = frozenset({
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+})
+
+# Caractères ASCII conservés tels quels dans la query string relayée
+_QUERY_SAFE = "!#$%&'()*+,/:;=?@[]~"
+# « % » non suivi de deux chiffres hexadécimaux : urllib3 réencoderait
+# alors tous les « % » de la query string, échappements valides compris
+_STRAY_PERCENT_RE = re.compile(rb"%(?![0-9A-Fa-f]{2})")
+
+# Cache des réponses GET : chaque entrée (ttl, status, headers, body)
+# expire selon son propre ttl (max-age de Fal ou STATUS_CACHE_TTL).
+# Borné en octets et non en nombre d'entrées.
+_RESPONSE_CACHE = TLRUCache(
+    maxsize=RESPONSE_CACHE_MAX_BYTES,
+    ttu=lambda _key, entry, now: now + entry[0],
+    timer=time.monotonic,
+    getsizeof=lambda entry: len(entry[3]) + RESPONSE_CACHE_ENTRY_OVERHEAD,
+)
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+# URLs Fal des images déjà envoyées, par empreinte BLAKE2 du contenu
+# (relances d'une même édition en changeant seulement le prompt)
+_UPLOAD_CACHE = TTLCache(maxsize=UPLOAD_CACHE_MAXSIZE, ttl=UPLOAD_CACHE_TTL)
+_UPLOAD_CACHE_LOCK = threading.Lock()
+
+# Pool d'upload partagé par toutes les requêtes /ui/edit : pas de threads
+# créés puis attendus à chaque formulaire, et une requête rejetée (400)
+# répond sans attendre la fin des uploads déjà lancés.
+_UPLOAD_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_UPLOAD_WORKERS, thread_name_prefix="fal-upload"
+)
+atexit.register(_UPLOAD_EXECUTOR.shutdown)
+
+# Créneaux d'appel à Fal (cf. fal_slot)
+_FAL_SEMAPHORE = threading.BoundedSemaphore(FAL_MAX_CONCURRENCY)
 
 
 def get_fal_key() -> str:
@@ -25,49 +213,224 @@ def get_fal_base() -> str:
     return base.rstrip("/")
 
 
+# Lus une seule fois à l'import : les variables d'environnement ne changent
+# pas après le démarrage, et un worker sans clé échoue dès son lancement
+# plutôt qu'à chaque requête.
+_FAL_KEY = get_fal_key()
+_FAL_BASE = get_fal_base()
+_AUTH_HEADER = f"Key {_FAL_KEY}"
+
+# Client Fal partagé, configuré une seule fois à l'import
+_FAL_CLIENT = fal_client.SyncClient(key=_FAL_KEY)
+
+
 def build_fal_url(path: str) -> str:
-    return f"{get_fal_base()}/{path.lstrip('/')}"
+    return f"{_FAL_BASE}/{path.lstrip('/')}"
+
+
+def get_hop_by_hop(headers, fixed: frozenset) -> frozenset:
+    """
+    En-têtes à ne pas relayer : la liste fixe, plus ceux que le champ
+    Connection désigne comme propres à la connexion (RFC 7230 §6.1).
+    """
+    named = headers.get("Connection")
+    if not named:
+        return fixed
+    return fixed | {t.strip().lower() for t in named.split(",") if t.strip()}
 
 
 def build_forward_headers(incoming_headers) -> dict:
-    headers = {}
-    for k, v in incoming_headers.items():
-        lk = k.lower()
-        if lk in ("host", "authorization", "content-length", "connection"):
-            continue
-        headers[k] = v
-    headers["Authorization"] = f"Key {get_fal_key()}"
+    hop_by_hop = get_hop_by_hop(incoming_headers, _HOP_BY_HOP_REQ)
+    headers = {
+        k: v
+        for k, v in incoming_headers.items()
+        if k.lower() not in hop_by_hop
+    }
+    headers["Authorization"] = _AUTH_HEADER
+    # Sans Accept-Encoding du client, requests demanderait gzip/br à Fal :
+    # le corps, relayé sans décompression, doit rester lisible par le client.
+    if "Accept-Encoding" not in headers:
+        headers["Accept-Encoding"] = "identity"
     return headers
 
 
-def forward_to_fal(method: str, path: str, args, headers, body: bytes) -> Response:
+def get_cache_ttl(path: str, resp_headers) -> int:
+    """
+    Durée de mise en cache d'une réponse GET : max-age fourni par Fal,
+    sinon un délai court pour les endpoints de statut, sinon 0.
+    """
+    directives = [
+        d.strip()
+        for d in resp_headers.get("Cache-Control", "").lower().split(",")
+        if d.strip()
+    ]
+    if any(d in ("no-store", "no-cache", "private") for d in directives):
+        return 0
+    for d in directives:
+        if d.startswith("max-age="):
+            try:
+                return max(0, int(d[len("max-age="):]))
+            except ValueError:
+                return 0
+    if path.rstrip("/").endswith("/status"):
+        return STATUS_CACHE_TTL
+    return 0
+
+
+class RequestBodyStream:
+    """
+    Corps de requête de longueur connue, relayé vers Fal sans être tamponné.
+    requests lit `len` pour poser Content-Length ; urllib3 ne peut rejouer
+    la requête (retry) que tant que rien n'a encore été lu.
+    """
+
+    def __init__(self, stream, length: int):
+        self._stream = stream
+        self._pos = 0
+        self.len = length
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._pos += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence != 0 or offset != self._pos:
+            raise OSError("request body cannot be rewound")
+        return self._pos
+
+
+def get_request_body(req):
+    """
+    Corps à transmettre à Fal : lu d’un bloc s’il tient dans un chunk
+    (les retries restent possibles), sinon relayé en flux.
+    """
+    length = req.content_length
+    if length is None:
+        # Corps chunked : longueur inconnue, requests le renvoie en chunked
+        if req.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            return req.stream
+        return b""
+    if length <= STREAM_CHUNK_SIZE:
+        return req.get_data()
+    return RequestBodyStream(req.stream, length)
+
+
+class FalBusy(Exception):
+    """
+    Tous les créneaux d’appel à Fal du processus restent occupés.
+    """
+
+
+@contextmanager
+def fal_slot():
+    """
+    Occupe un des FAL_MAX_CONCURRENCY créneaux d’appel à Fal le temps du
+    bloc, à garder autour de l’appel seul : jamais pendant la réception
+    d’un corps envoyé par le client. Sous une rafale, la requête attend au plus
+    FAL_ACQUIRE_TIMEOUT puis est rejetée (FalBusy -> 503) au lieu de
+    s’empiler sur Fal et sur la mémoire du worker.
+    """
+    if not _FAL_SEMAPHORE.acquire(timeout=FAL_ACQUIRE_TIMEOUT):
+        raise FalBusy()
+    try:
+        yield
+    finally:
+        _FAL_SEMAPHORE.release()
+
+
+def forward_to_fal(
+    method: str, path: str, query_string: bytes, headers, body
+) -> Response:
     """
     Proxy générique /fal/<path> vers l’API Fal (texte -> image, etc.).
     """
     url = build_fal_url(path)
-    params = {k: v for k, v in args.lists()}
+    # Query string déjà encodée par le client : les échappements existants
+    # sont conservés, seuls les octets hors ASCII et les « % » isolés sont
+    # percent-encodés (jamais d'erreur de décodage ; urllib3 encode encore
+    # les caractères hors RFC 3986, sans changer les valeurs)
+    if query_string:
+        query_string_out = _STRAY_PERCENT_RE.sub(b"%25", query_string)
+        url = f"{url}?{quote_from_bytes(query_string_out, safe=_QUERY_SAFE)}"
     fal_headers = build_forward_headers(headers)
 
-    try:
-        resp = requests.request(
-            method=method,
-            url=url,
-            headers=fal_headers,
-            params=params,
-            data=body,
-            timeout=TIMEOUT_SECONDS,
+    # L'Authorization envoyée à Fal est toujours la clé du proxy :
+    # elle n'a pas besoin de figurer dans la clé de cache. Le corps étant
+    # stocké compressé, l'Accept-Encoding en fait partie.
+    cache_key = None
+    if method == "GET":
+        cache_key = (path, query_string, fal_headers["Accept-Encoding"])
+        with _RESPONSE_CACHE_LOCK:
+            cached = _RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            _, status, cached_headers, cached_body = cached
+            # copie : Response réutilise l'objet Headers et le complète
+            return Response(cached_body, status=status, headers=cached_headers.copy())
+
+    # Échec réseau (requests ou urllib3) : traduit en 502 par handle_fal_error.
+    # Créneau Fal pris seulement pour un corps déjà en mémoire (rendu dès les
+    # en-têtes reçus) : un corps en flux avance au rythme du client, qui ne
+    # doit pas bloquer les autres appels.
+    buffered = isinstance(body, bytes)
+    session = _SESSION if buffered else _STREAM_SESSION
+    # requests réécrit l'URL à la préparation (requote_uri : %41 -> A,
+    # | -> %7C, tous les % réencodés si une séquence est invalide) :
+    # l'URL construite plus haut est remise telle quelle avant l'envoi.
+    prep = session.prepare_request(
+        requests.Request(method=method, url=url, headers=fal_headers, data=body)
+    )
+    prep.url = url
+    settings = session.merge_environment_settings(url, {}, True, None, None)
+    with fal_slot() if buffered else nullcontext():
+        resp = session.send(
+            prep,
+            timeout=(CONNECT_TIMEOUT_SECONDS, TIMEOUT_SECONDS),
+            **settings,
         )
-    except Exception as e:
-        return jsonify({"error": "request_to_fal_failed", "detail": str(e)}), 502
-
-    excluded = {"content-encoding", "transfer-encoding", "connection"}
-    clean_headers = [
-        (name, value)
-        for name, value in resp.headers.items()
-        if name.lower() not in excluded
-    ]
 
-    return Response(resp.content, status=resp.status_code, headers=clean_headers)
+    hop_by_hop = get_hop_by_hop(resp.headers, _HOP_BY_HOP_RESP)
+    clean_headers = Headers()
+    for name, value in resp.headers.items():
+        if name.lower() not in hop_by_hop:
+            clean_headers.add(name, value)
+
+    ttl = 0
+    if cache_key is not None and 200 <= resp.status_code < 300:
+        # Seuls les petits corps de taille annoncée sont lus en mémoire
+        content_length = resp.headers.get("Content-Length", "")
+        if content_length.isdigit() and int(content_length) <= RESPONSE_CACHE_MAX_ENTRY:
+            ttl = get_cache_ttl(path, resp.headers)
+    if ttl > 0:
+        try:
+            body = resp.raw.read(decode_content=False)
+        finally:
+            resp.close()
+        with _RESPONSE_CACHE_LOCK:
+            _RESPONSE_CACHE[cache_key] = (
+                ttl, resp.status_code, clean_headers.copy(), body
+            )
+        return Response(body, status=resp.status_code, headers=clean_headers)
+
+    def generate():
+        # Octets bruts de Fal, sans décompression (Content-Encoding conservé)
+        try:
+            for chunk in resp.raw.stream(STREAM_CHUNK_SIZE, decode_content=False):
+                if chunk:
+                    yield chunk
+        finally:
+            resp.close()
+
+    # direct_passthrough : Werkzeug relaie les chunks sans les réencapsuler
+    return Response(
+        stream_with_context(generate()),
+        status=resp.status_code,
+        headers=clean_headers,
+        direct_passthrough=True,
+    )
 
 
 def sanitize_extra_for_model(model_id: str, extra: dict) -> dict:
@@ -111,36 +474,171 @@ def sanitize_extra_for_model(model_id: str, extra: dict) -> dict:
     return extra
 
 
-def run_image_edit(model_id: str, prompt: str, files, extra_args=None) -> dict:
+def upload_image(data: bytes, content_type: str, file_name: str, digest: str) -> str:
     """
-    Upload toutes les images vers Fal et appelle le modèle
-    avec image_urls = [...]
+    Upload direct des octets reçus vers Fal, sans fichier temporaire.
+    Une image déjà envoyée (même empreinte) réutilise l’URL Fal en cache.
     """
-    fal_client.api_key = get_fal_key()
-    image_urls = []
+    with _UPLOAD_CACHE_LOCK:
+        url = _UPLOAD_CACHE.get(digest)
+    if url is None:
+        with fal_slot():
+            url = _FAL_CLIENT.upload(data, content_type=content_type, file_name=file_name)
+        with _UPLOAD_CACHE_LOCK:
+            _UPLOAD_CACHE[digest] = url
+    return url
+
 
-    for file_storage in files:
-        if not file_storage or not file_storage.filename:
-            continue
+class EditFormTooLarge(Exception):
+    """
+    Formulaire /ui/edit hors limites (nombre ou taille des images) ;
+    le message est le code d’erreur renvoyé au client.
+    """
 
-        suffix = os.path.splitext(file_storage.filename)[1] or ".png"
-        tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        tmp_name = tmp_file.name
-        tmp_file.close()
 
-        file_storage.save(tmp_name)
+class InvalidEditForm(Exception):
+    """
+    Corps multipart de /ui/edit illisible (boundary erronée, corps tronqué).
+    """
+
+
+def read_edit_form(req, executor) -> tuple:
+    """
+    Lit le formulaire multipart de /ui/edit au fil de l’eau : chaque image
+    est soumise à l’upload Fal dès que sa partie est reçue, pendant que le
+    navigateur envoie les suivantes. Retourne (champs, futures d’upload).
+    Lève EditFormTooLarge dès qu’une limite est dépassée, sans lire la suite,
+    et InvalidEditForm si le corps n’est pas un multipart valide.
+    """
+    fields = {}
+    uploads = []
+    image_count = 0
+    size = 0
+    pending = {}  # empreinte -> future, images identiques dans la requête
+    boundary = req.mimetype_params.get("boundary")
+    if req.mimetype != "multipart/form-data" or not boundary:
+        return fields, uploads
+
+    # Pas de max_form_memory_size ici : le décodeur l’applique au bloc lu
+    # (FORM_READ_SIZE), pas à la partie ; les tailles sont vérifiées plus bas.
+    decoder = MultipartDecoder(
+        boundary.encode("latin-1"),
+        max_parts=req.max_form_parts,
+    )
+    part = None
+    chunks = []
+    stream = req.stream
+
+    def next_event():
         try:
-            url = fal_client.upload_file(tmp_name)
-            image_urls.append(url)
-        finally:
-            try:
-                os.remove(tmp_name)
-            except OSError:
-                pass
+            return decoder.next_event()
+        except ValueError as e:
+            raise InvalidEditForm(str(e)) from e
 
-    if not image_urls:
-        raise RuntimeError("No valid images were uploaded")
+    # Formulaire rejeté en cours de lecture : les images déjà reçues
+    # ne partent pas vers Fal si leur upload n’a pas encore démarré
+    try:
+        while True:
+            data = stream.read(FORM_READ_SIZE)
+            decoder.receive_data(data or None)
+            event = next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, (Field, File)):
+                    part = event
+                    chunks = []
+                    size = 0
+                    if isinstance(part, File) and part.name == "images" and part.filename:
+                        image_count += 1
+                        if image_count > MAX_EDIT_IMAGES:
+                            raise EditFormTooLarge("too_many_images")
+                elif isinstance(event, Data):
+                    size += len(event.data)
+                    if isinstance(part, File):
+                        if size > MAX_IMAGE_SIZE:
+                            raise EditFormTooLarge("image_too_large")
+                    elif req.max_form_memory_size and size > req.max_form_memory_size:
+                        raise RequestEntityTooLarge()
+                    chunks.append(event.data)
+                    if not event.more_data:
+                        value = b"".join(chunks)
+                        if isinstance(part, Field):
+                            fields[part.name] = value.decode("utf-8", "replace")
+                        elif part.name == "images" and part.filename:
+                            digest = hashlib.blake2b(value, digest_size=16).hexdigest()
+                            if digest not in pending:
+                                pending[digest] = executor.submit(
+                                    upload_image,
+                                    value,
+                                    part.headers.get("Content-Type") or "image/png",
+                                    part.filename,
+                                    digest,
+                                )
+                            uploads.append(pending[digest])
+                event = next_event()
+            if not data or isinstance(event, Epilogue):
+                break
+    except BaseException:
+        cancel_uploads(uploads)
+        raise
+
+    return fields, uploads
+
+
+def cancel_uploads(uploads) -> None:
+    """
+    Annule les uploads pas encore démarrés d’un formulaire rejeté ;
+    ceux en cours vont à leur terme (et alimentent le cache d’upload).
+    """
+    for upload in uploads:
+        upload.cancel()
+
+
+def collect_uploads(uploads) -> tuple:
+    """
+    Attend la fin des uploads (ordre des images conservé). Un upload en
+    échec n’interrompt pas les autres : retourne (urls, erreurs).
+    FalBusy (créneaux saturés) est propagée : la requête entière est rejetée.
+    """
+    urls = []
+    errors = []
+    for upload in uploads:
+        try:
+            urls.append(upload.result())
+        except FalBusy:
+            cancel_uploads(uploads)
+            raise
+        except Exception as e:
+            errors.append(str(e))
+    return urls, errors
+
+
+@lru_cache(maxsize=EXTRA_CACHE_MAXSIZE)
+def _load_extra_json(extra_json: str) -> dict:
+    try:
+        extra = orjson.loads(extra_json)
+    except orjson.JSONDecodeError:
+        return {}
+    return extra if isinstance(extra, dict) else {}
 
+
+def parse_extra_json(extra_json: str) -> dict:
+    """
+    Paramètres supplémentaires du formulaire (objet JSON, {} si invalide).
+    L’UI renvoie souvent la même chaîne : le résultat est mis en cache,
+    et une copie est retournée pour que l’entrée en cache reste intacte.
+    """
+    if len(extra_json) > EXTRA_CACHE_MAX_LEN:
+        return _load_extra_json.__wrapped__(extra_json)
+    return dict(_load_extra_json(extra_json))
+
+
+def submit_image_edit(
+    model_id: str, prompt: str, image_urls: list, extra_args=None
+) -> dict:
+    """
+    Soumet le modèle (image_urls = [...]) à la file d’attente Fal,
+    sans attendre le résultat.
+    """
     extra = extra_args or {}
     extra = sanitize_extra_for_model(model_id, extra)
 
@@ -150,406 +648,197 @@ def run_image_edit(model_id: str, prompt: str, files, extra_args=None) -> dict:
     }
     arguments.update(extra)
 
-    result = fal_client.run(model_id, arguments=arguments)
+    with fal_slot():
+        handle = _FAL_CLIENT.submit(model_id, arguments=arguments)
 
-    if isinstance(result, dict):
+    return {
+        "request_id": handle.request_id,
+        "model": model_id,
+        "status": "IN_QUEUE",
         # Pour debug : voir quelles URLs d’entrée ont servi
-        result["_debug_image_urls"] = image_urls
+        "_debug_image_urls": image_urls,
+    }
 
-    return result
+
+class OrjsonProvider(JSONProvider):
+    """
+    Sérialisation JSON de Flask (jsonify, get_json) via orjson.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        # orjson produit directement des bytes : pas de passage par str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
 
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+
+# Page d'accueil lue et compressée une seule fois au démarrage :
+# encodage -> (corps, ETag), une ETag distincte par représentation
+with open(os.path.join(app.static_folder, "index.html"), "rb") as f:
+    _INDEX_HTML = f.read()
+_INDEX_DIGEST = hashlib.sha256(_INDEX_HTML).hexdigest()[:16]
+_INDEX_VARIANTS = {
+    "br": (brotli.compress(_INDEX_HTML, quality=11), f'"{_INDEX_DIGEST}-br"'),
+    "gzip": (gzip.compress(_INDEX_HTML, compresslevel=9), f'"{_INDEX_DIGEST}-gz"'),
+    None: (_INDEX_HTML, f'"{_INDEX_DIGEST}"'),
+}
+
+# Réponse de santé figée à l'import : les sondes du load balancer
+# ne coûtent ni allocation ni encodage JSON
+_HEALTH_BODY = orjson.dumps({
+    "status": "ok",
+    "message": "Fal proxy running",
+    "fal_base": _FAL_BASE,
+})
+
+
+@app.errorhandler(requests.RequestException)
+@app.errorhandler(Urllib3HTTPError)
+def handle_fal_error(e):
+    # Fal injoignable ou connexion coupée avant la réponse
+    return jsonify({"error": "request_to_fal_failed", "detail": str(e)}), 502
+
+
+@app.errorhandler(FalBusy)
+def handle_fal_busy(e):
+    return jsonify({"error": "fal_busy"}), 503, {"Retry-After": str(FAL_RETRY_AFTER)}
+
+
+@app.errorhandler(InvalidEditForm)
+def handle_invalid_edit_form(e):
+    return jsonify({"error": "invalid_form", "detail": str(e)}), 400
+
+
+@app.errorhandler(EditFormTooLarge)
+def handle_edit_form_too_large(e):
+    return jsonify({"error": str(e)}), 413
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(e):
+    # Corps au-delà de MAX_CONTENT_LENGTH (ou champ texte trop long)
+    return jsonify({"error": "request_too_large"}), 413
+
+
+@app.errorhandler(Exception)
+def handle_unexpected_error(e):
+    """
+    Point unique de traduction des erreurs en JSON : les routes ne
+    capturent plus elles-mêmes les exceptions. Les erreurs HTTP
+    (404, 405...) gardent la réponse standard de Werkzeug.
+    """
+    if isinstance(e, HTTPException):
+        return e
+    # Flask ne journalise plus lui-même une exception prise en charge ici :
+    # la trace doit rester dans le log d'erreurs de gunicorn.
+    app.log_exception(sys.exc_info())
+    return jsonify({"error": "internal_error", "detail": str(e)}), 500
 
 
 @app.route("/", methods=["GET"])
 def index():
-    # UI HTML (texte->image + image->image)
-    return '''
-<!doctype html>
-<html lang="fr">
-<head>
-  <meta charset="utf-8">
-  <title>Fal Proxy UI</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <style>
-    body { font-family: system-ui, sans-serif; margin: 1.5rem; max-width: 980px; }
-    label { display: block; margin-top: 0.75rem; font-weight: 600; }
-    input[type="text"], textarea, select { width: 100%; padding: 0.5rem; margin-top: 0.25rem; box-sizing: border-box; }
-    textarea { min-height: 140px; font-family: monospace; }
-    button { margin-top: 0.75rem; padding: 0.6rem 1.2rem; font-size: 1rem; cursor: pointer; }
-    img { border-radius: 4px; }
-    #previewContainer img { max-width: 110px; margin-right: 10px; border:1px solid #ccc; padding:3px; }
-    pre { background: #111; color:#0f0; padding:0.75rem; white-space: pre-wrap; }
-    .row { display:flex; gap:1rem; flex-wrap:wrap; margin-top:1rem; }
-    .row > div { flex:1 1 260px; }
-    .hint { font-size: 0.85rem; color:#555; }
-    .inline { display:flex; gap:0.5rem; align-items:center; flex-wrap:wrap; }
-    .inline > * { flex: 0 0 auto; }
-  </style>
-</head>
-
-<body>
-
-<h1>Fal Proxy – Interface</h1>
-
-<h2>1. Texte → Image (proxy générique)</h2>
-
-<form id="falForm">
-  <label>Modèle / chemin Fal
-    <input type="text" id="modelPath" value="fal-ai/flux/dev">
-  </label>
-
-  <label>JSON
-    <textarea id="jsonInput">
-{
-  "prompt": "beautiful cinematic portrait",
-  "num_images": 1
-}
-    </textarea>
-  </label>
-
-  <button type="submit">Générer (Texte → Image)</button>
-  <div id="status"></div>
-</form>
-
-<div class="row">
-  <div>
-    <h3>Images</h3>
-    <div id="images"></div>
-  </div>
-  <div>
-    <h3>Réponse brute</h3>
-    <pre id="rawOutput"></pre>
-  </div>
-</div>
-
-
-<h2>2. Image → Image (Seedream / Nano-Banana Pro)</h2>
-
-<form id="editForm" enctype="multipart/form-data">
-
-  <label>Modèle d'édition
-    <select id="editModel">
-      <option value="fal-ai/bytedance/seedream/v4/edit" selected>Seedream v4 – Edit</option>
-      <option value="fal-ai/nano-banana-pro/edit">Nano-Banana Pro – Edit</option>
-    </select>
-  </label>
-
-  <div id="modelOptions" class="hint">
-  </div>
-
-  <label>Images (multiple autorisé)
-    <input type="file" id="editImages" accept="image/*" multiple>
-  </label>
-
-  <div id="previewContainer"></div>
-
-  <label>Prompt
-    <textarea id="editPrompt"></textarea>
-  </label>
-
-  <label>Options avancées (JSON fusionné)
-    <textarea id="editExtraJson">
-{}
-    </textarea>
-    <div class="hint">
-      Les paramètres ci-dessus seront fusionnés avec ceux choisis dans les menus (image_size ou aspect_ratio / resolution).
-    </div>
-  </label>
-
-  <button type="submit">Générer (Image → Image)</button>
-  <div id="editStatus"></div>
-
-</form>
-
-<div class="row">
-  <div>
-    <h3>Images éditées</h3>
-    <div id="editImagesOutput"></div>
-  </div>
-  <div>
-    <h3>Réponse brute (édition)</h3>
-    <pre id="editRawOutput"></pre>
-  </div>
-</div>
-
-<script>
-// --- Preview des images ---
-const inputImgs = document.getElementById("editImages");
-const preview = document.getElementById("previewContainer");
-
-inputImgs.addEventListener("change", () => {
-  preview.innerHTML = "";
-  [...inputImgs.files].forEach(file => {
-    const img = document.createElement("img");
-    img.src = URL.createObjectURL(file);
-    preview.appendChild(img);
-  });
-});
-
-// --- Texte -> Image ---
-document.getElementById("falForm").addEventListener("submit", async (e) => {
-  e.preventDefault();
-
-  const modelPathInput = document.getElementById("modelPath");
-  const rawJson = document.getElementById("jsonInput").value;
-  const status = document.getElementById("status");
-  const imagesDiv = document.getElementById("images");
-  const rawOut = document.getElementById("rawOutput");
-
-  imagesDiv.innerHTML = "";
-  rawOut.textContent = "";
-  status.textContent = "Envoi...";
-
-  let modelPath = modelPathInput.value.trim();
-  while (modelPath.startsWith("/")) {
-    modelPath = modelPath.slice(1);
-  }
-
-  let payload;
-  try {
-    payload = JSON.parse(rawJson);
-  } catch (e2) {
-    status.textContent = "JSON invalide : " + e2.message;
-    return;
-  }
-
-  try {
-    const resp = await fetch("/fal/" + modelPath, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(payload)
-    });
-    const text = await resp.text();
-    rawOut.textContent = text;
-    status.textContent = "HTTP " + resp.status;
-
-    let data = null;
-    try { data = JSON.parse(text); } catch (_) {}
-
-    if (data && Array.isArray(data.images)) {
-      data.images.forEach(img => {
-        const url = img.url || img.image_url;
-        if (url) {
-          const im = document.createElement("img");
-          im.src = url;
-          im.style.maxWidth = "100%";
-          imagesDiv.appendChild(im);
-        }
-      });
+    # UI HTML (texte->image + image->image), servie depuis static/index.html
+    encoding = None
+    for candidate in ("br", "gzip"):
+        if request.accept_encodings[candidate] > 0:
+            encoding = candidate
+            break
+    body, etag = _INDEX_VARIANTS[encoding]
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={INDEX_MAX_AGE}",
+        "Vary": "Accept-Encoding",
     }
-  } catch (err) {
-    status.textContent = "Erreur : " + err.message;
-  }
-});
-
-// --- UI dynamique selon le modèle ---
-const editModel = document.getElementById("editModel");
-const modelOptionsDiv = document.getElementById("modelOptions");
-
-function renderModelOptions() {
-  const model = editModel.value;
-  let html = "";
-
-  if (model === "fal-ai/bytedance/seedream/v4/edit") {
-    html += '<div class="inline">';
-    html += '<span>Taille d&#39;image (Seedream) :</span>';
-    html += '<select id="seedreamSize">';
-    html += '<option value="">(défaut)</option>';
-    html += '<option value="auto">auto</option>';
-    html += '<option value="auto_2K">auto_2K</option>';
-    html += '<option value="auto_4K">auto_4K</option>';
-    html += '<option value="square">square</option>';
-    html += '<option value="square_hd">square_hd</option>';
-    html += '<option value="portrait_4_3">portrait_4_3</option>';
-    html += '<option value="portrait_16_9">portrait_16_9</option>';
-    html += '<option value="landscape_4_3">landscape_4_3</option>';
-    html += '<option value="landscape_16_9">landscape_16_9</option>';
-    html += '<option value="custom">custom (width/height)</option>';
-    html += '</select>';
-    html += '<span id="seedreamCustom" style="display:none;"> ';
-    html += 'W:<input type="number" id="seedreamW" style="width:80px" min="256" step="64"> ';
-    html += 'H:<input type="number" id="seedreamH" style="width:80px" min="256" step="64">';
-    html += '</span>';
-    html += '</div>';
-    html += '<div class="hint">Seedream : utilise image_size (enum) ou image_size = {width,height} pour custom.</div>';
-  } else if (model === "fal-ai/nano-banana-pro/edit") {
-    html += '<div class="inline">';
-    html += '<span>Aspect ratio :</span>';
-    html += '<select id="nanoAspect">';
-    html += '<option value="auto">auto</option>';
-    html += '<option value="21:9">21:9</option>';
-    html += '<option value="16:9">16:9</option>';
-    html += '<option value="3:2">3:2</option>';
-    html += '<option value="4:3">4:3</option>';
-    html += '<option value="5:4">5:4</option>';
-    html += '<option value="1:1">1:1</option>';
-    html += '<option value="4:5">4:5</option>';
-    html += '<option value="3:4">3:4</option>';
-    html += '<option value="2:3">2:3</option>';
-    html += '<option value="9:16">9:16</option>';
-    html += '</select>';
-    html += '</div>';
-
-    html += '<div class="inline">';
-    html += '<span>Resolution :</span>';
-    html += '<select id="nanoRes">';
-    html += '<option value="">(défaut)</option>';
-    html += '<option value="1K">1K</option>';
-    html += '<option value="2K">2K</option>';
-    html += '<option value="4K">4K</option>';
-    html += '</select>';
-    html += '</div>';
-
-    html += '<div class="hint">Nano-Banana Pro : aspect_ratio + resolution (1K/2K/4K).</div>';
-  }
-
-  modelOptionsDiv.innerHTML = html;
-
-  const seedreamSize = document.getElementById("seedreamSize");
-  const seedreamCustom = document.getElementById("seedreamCustom");
-  if (seedreamSize && seedreamCustom) {
-    seedreamSize.addEventListener("change", () => {
-      if (seedreamSize.value === "custom") {
-        seedreamCustom.style.display = "inline-flex";
-      } else {
-        seedreamCustom.style.display = "none";
-      }
-    });
-  }
-}
+    # If-None-Match : comparaison faible (RFC 7232 §3.2), un intermédiaire
+    # peut avoir affaibli l'ETag en W/"..."
+    if request.if_none_match.contains_weak(etag.strip('"')):
+        return Response(status=304, headers=headers)
 
-editModel.addEventListener("change", renderModelOptions);
-renderModelOptions();
-
-// --- Image -> Image submit ---
-document.getElementById("editForm").addEventListener("submit", async (e) => {
-  e.preventDefault();
-
-  const files = [...inputImgs.files];
-  const editStatus = document.getElementById("editStatus");
-  const out = document.getElementById("editImagesOutput");
-  const raw = document.getElementById("editRawOutput");
-  const model = editModel.value;
-
-  out.innerHTML = "";
-  raw.textContent = "";
-  if (!files.length) {
-    editStatus.textContent = "Aucune image.";
-    return;
-  }
-
-  let extra = {};
-  try {
-    extra = JSON.parse(document.getElementById("editExtraJson").value || "{}");
-  } catch (e2) {
-    editStatus.textContent = "JSON options invalide : " + e2.message;
-    return;
-  }
-
-  // Options spécifiques au modèle
-  if (model === "fal-ai/bytedance/seedream/v4/edit") {
-    const seedreamSize = document.getElementById("seedreamSize");
-    if (seedreamSize) {
-      const val = seedreamSize.value;
-      delete extra["image_size"];
-
-      if (val === "custom") {
-        const w = parseInt(document.getElementById("seedreamW").value || "0", 10);
-        const h = parseInt(document.getElementById("seedreamH").value || "0", 10);
-        if (w > 0 && h > 0) {
-          extra["image_size"] = { "width": w, "height": h };
-        }
-      } else if (val) {
-        extra["image_size"] = val;
-      }
-    }
-  } else if (model === "fal-ai/nano-banana-pro/edit") {
-    const nanoAspect = document.getElementById("nanoAspect");
-    const nanoRes = document.getElementById("nanoRes");
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, mimetype="text/html", headers=headers)
 
-    if (nanoAspect && nanoAspect.value) {
-      extra["aspect_ratio"] = nanoAspect.value;
-    }
-    if (nanoRes && nanoRes.value) {
-      extra["resolution"] = nanoRes.value;
-    }
-  }
-
-  const fd = new FormData();
-  fd.append("model", model);
-  fd.append("prompt", document.getElementById("editPrompt").value || "");
-  fd.append("extra_json", JSON.stringify(extra));
-  files.forEach(f => fd.append("images", f));
-
-  editStatus.textContent = "Envoi...";
-
-  try {
-    const resp = await fetch("/ui/edit", { method: "POST", body: fd });
-    const text = await resp.text();
-    raw.textContent = text;
-    editStatus.textContent = "HTTP " + resp.status;
-
-    let data = null;
-    try { data = JSON.parse(text); } catch (_) {}
-
-    if (data && Array.isArray(data.images)) {
-      data.images.forEach(img => {
-        const url = img.url || img.image_url;
-        if (url) {
-          const im = document.createElement("img");
-          im.src = url;
-          im.style.maxWidth = "100%";
-          out.appendChild(im);
-        }
-      });
-    }
-  } catch (err) {
-    editStatus.textContent = "Erreur : " + err.message;
-  }
-});
-</script>
 
-</body>
-</html>
-'''
+@app.route("/health", methods=["GET"])
+def health():
+    return Response(_HEALTH_BODY, mimetype="application/json")
 
 
 @app.route("/fal/<path:fal_path>", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
 def fal_proxy(fal_path):
+    # Préflight CORS : réponse locale, sans aller-retour vers Fal
+    if request.method == "OPTIONS":
+        return Response(status=204, headers={
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "GET,POST,PUT,DELETE,PATCH,OPTIONS",
+            "Access-Control-Allow-Headers": request.headers.get(
+                "Access-Control-Request-Headers", "*"
+            ),
+            "Access-Control-Max-Age": "86400",
+        })
+
     return forward_to_fal(
         request.method,
         fal_path,
-        request.args,
+        request.query_string,
         request.headers,
-        request.get_data()
+        get_request_body(request),
     )
 
 
 @app.route("/ui/edit", methods=["POST"])
 def ui_edit():
-    model = request.form.get("model")
-    prompt = request.form.get("prompt") or ""
-    extra_json = request.form.get("extra_json") or "{}"
-    files = request.files.getlist("images")
+    # Les images partent vers Fal pendant la réception du formulaire
+    fields, uploads = read_edit_form(request, _UPLOAD_EXECUTOR)
+
+    model = fields.get("model")
+    prompt = fields.get("prompt") or ""
+    extra = parse_extra_json(fields.get("extra_json") or "{}")
 
-    if not files:
+    if not uploads:
         return jsonify({"error": "missing_images"}), 400
     if not model:
+        cancel_uploads(uploads)
         return jsonify({"error": "missing_model"}), 400
 
-    try:
-        extra = json.loads(extra_json)
-    except Exception:
-        extra = {}
-
-    try:
-        result = run_image_edit(model, prompt, files, extra)
-        return jsonify(result)
-    except Exception as e:
-        return jsonify({"error": "edit_failed", "detail": str(e)}), 500
-
+    # Le worker est libéré dès la soumission : le navigateur interroge
+    # ensuite /ui/edit/status/<request_id> jusqu'au résultat.
+    image_urls, upload_errors = collect_uploads(uploads)
+    if not image_urls:
+        return jsonify({
+            "error": "upload_failed",
+            "detail": "No valid images were uploaded: " + "; ".join(upload_errors),
+        }), 502
+    job = submit_image_edit(model, prompt, image_urls, extra)
+    if upload_errors:
+        job["_upload_errors"] = upload_errors
+    return jsonify(job), 202
+
+
+@app.route("/ui/edit/status/<request_id>", methods=["GET"])
+def ui_edit_status(request_id):
+    model = request.args.get("model")
+    if not model:
+        return jsonify({"error": "missing_model"}), 400
 
-if __name__ == "__main__":
-    app.run(port=5000, debug=True)
+    status = _FAL_CLIENT.status(model, request_id)
+    if isinstance(status, fal_client.Queued):
+        return jsonify({
+            "request_id": request_id,
+            "status": "IN_QUEUE",
+            "position": status.position,
+        }), 202
+    if not isinstance(status, fal_client.Completed):
+        return jsonify({"request_id": request_id, "status": "IN_PROGRESS"}), 202
+
+    return jsonify(_FAL_CLIENT.result(model, request_id))
@@ -0,0 +1,14 @@
+# Configuration gunicorn, chargée automatiquement depuis le répertoire courant.
+# Workers gevent : chaque appel Fal en attente ne bloque qu'un greenlet.
+import multiprocessing
+import os
+
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Garder aligné avec la taille du pool HTTP vers Fal (app.py)
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", "1000"))
+# Connexions client (nginx, load balancer) réutilisées entre requêtes ;
+# au-dessus des 60 s d'inactivité usuelles côté proxy
+keepalive = 75
+# Un peu au-delà de TIMEOUT_SECONDS (app.py) pour laisser l'appel Fal expirer d'abord
+timeout = 310